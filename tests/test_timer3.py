@@ -0,0 +1,355 @@
+"""Tests for Timer3."""
+import asyncio
+import contextvars
+import copy
+import csv
+import inspect
+import pickle
+import threading
+import weakref
+
+import pytest
+
+from timer3 import Timer3
+
+
+@pytest.fixture(name="nested_timer")
+def fixture_nested_timer():
+    """Timer with nested sections and decorated functions."""
+    timer = Timer3()
+
+    @timer.timethis(name="inner function")
+    def inner():
+        pass
+
+    @timer.timethis()
+    def outer():
+        inner()
+        inner()
+
+    with timer.time("first context"):
+        inner()
+        with timer.time("deep"):
+            outer()
+    inner()
+    outer()
+    return timer
+
+
+def test_nested_call_order(nested_timer):
+    """Test that nested sections are recorded and rendered in call order."""
+    assert nested_timer.names == [
+        "first context",
+        "inner function",
+        "deep",
+        "fixture_nested_timer.<locals>.outer",
+        "inner function",
+        "inner function",
+        "inner function",
+        "fixture_nested_timer.<locals>.outer",
+        "inner function",
+        "inner function",
+    ]
+    assert nested_timer.states == [0, 1, 1, 2, 3, 3, 0, 0, 1, 1]
+    assert nested_timer.sort_by_call_order() == range(10)
+    assert nested_timer.current_state == -1
+    table = str(nested_timer)
+    assert "|   deep " in table
+    assert "|       inner function " in table
+
+
+def test_render_new_sections(nested_timer):
+    """Test that sections recorded after rendering are added to the table."""
+    str(nested_timer)
+    with nested_timer.time("first context"):
+        with nested_timer.time("a name longer than the others"):
+            pass
+    table = str(nested_timer)
+    assert "|   a name longer than the others " in table
+    assert table.count("| first context ") == 2
+    assert len(set(map(len, table.splitlines()))) == 1
+
+
+def test_fixed_argument_wrapper():
+    """Test that the generated wrappers behave like the decorated functions."""
+    timer = Timer3()
+
+    @timer.timethis()
+    def add(a, b):
+        return a + b
+
+    @timer.timethis()
+    def add_default(a, b=1):
+        return a + b
+
+    assert add(1, 2) == 3
+    assert add(a=1, b=2) == 3
+    assert add_default(1) == 2
+    assert add.__name__ == "add"
+    with pytest.raises(TypeError):
+        add(1)
+    assert timer.names == [add.__qualname__] * 2 + [add_default.__qualname__]
+
+
+def test_custom_signature():
+    """Test that a custom signature does not change the arguments passed on."""
+    timer = Timer3()
+
+    def collect(*args, **kwargs):
+        return args, kwargs
+
+    collect.__signature__ = inspect.signature(lambda a, b: None)
+    assert timer.timethis()(collect)(1, 2) == ((1, 2), {})
+
+
+def test_log_function():
+    """Test the verbose output."""
+    messages = []
+    timer = Timer3()
+    with timer.time("section", log_function=messages.append):
+        pass
+    assert messages[0] == "Starting section"
+    assert messages[1] == f"section done, took {timer.times[0]}s"
+
+
+def test_exception_is_recorded():
+    """Test that a section left by an exception is recorded and the state restored."""
+    timer = Timer3()
+    with pytest.raises(ValueError):
+        with timer.time("failing"):
+            raise ValueError
+    assert timer.names == ["failing"]
+    assert timer.times[0] >= 0
+    assert timer.current_state == -1
+
+
+def test_running_section():
+    """Test that running sections are labeled and skipped in the summary."""
+    timer = Timer3()
+    with timer.time("outer"):
+        with timer.time("inner"):
+            pass
+        assert timer.current_state == 0
+        assert timer.times[0] is None
+        assert "running" in str(timer)
+        summary = timer.summary()
+    assert list(summary) == ["inner"]
+    assert summary["inner"]["self"] == summary["inner"]["total"]
+
+
+def test_times(nested_timer):
+    """Test the read-only view of the times in seconds."""
+    times = nested_timer.times
+    assert len(times) == 10
+    assert times[-1] == nested_timer.times_ns[9] / 1e9
+    assert times[1:3] == list(times)[1:3]
+    with pytest.raises(IndexError):
+        times[10]
+    with pytest.raises(AttributeError):
+        nested_timer.times = []
+
+
+def test_summary_self_time(nested_timer):
+    """Test calls, total and self times of nested sections."""
+    times = nested_timer.times
+    summary = nested_timer.summary()
+    assert summary["inner function"]["calls"] == 6
+    assert summary["inner function"]["self"] == summary["inner function"]["total"]
+    assert summary["first context"]["total"] == times[0]
+    assert summary["first context"]["self"] == pytest.approx(times[0] - times[1] - times[2])
+    assert summary["deep"]["self"] == pytest.approx(times[2] - times[3])
+
+
+def test_recursive_summary():
+    """Test that recursive calls are only counted once in the total time."""
+    timer = Timer3()
+
+    @timer.timethis()
+    def countdown(n):
+        if n:
+            countdown(n - 1)
+
+    countdown(3)
+    summary = timer.summary()["test_recursive_summary.<locals>.countdown"]
+    assert summary["calls"] == 4
+    assert summary["total"] == timer.times[0]
+    assert summary["self"] == pytest.approx(timer.times[0])
+    assert summary["depths"] == {0: 1, 1: 1, 2: 1, 3: 1}
+
+
+def test_concurrent_tasks():
+    """Test that concurrent tasks are nested in the section creating them."""
+    timer = Timer3()
+
+    async def job(i):
+        with timer.time(f"task{i}"):
+            await asyncio.sleep(0.01 * (3 - i))
+            with timer.time(f"sub{i}"):
+                assert timer.current_state == 2
+                await asyncio.sleep(0.01)
+
+    async def main():
+        with timer.time("main"):
+            await asyncio.gather(*(job(i) for i in range(3)))
+
+    asyncio.run(main())
+    names = [timer.names[i] for i in timer.sort_by_call_order()]
+    assert names == ["main", "task0", "sub0", "task1", "sub1", "task2", "sub2"]
+    assert timer.parents[timer.names.index("sub1")] == timer.names.index("task1")
+    assert all(entry["self"] >= 0 for entry in timer.summary().values())
+
+
+def test_concurrent_threads():
+    """Test that threads keep their own nesting."""
+    timer = Timer3()
+
+    def work():
+        for _ in range(200):
+            with timer.time("outer"):
+                with timer.time("inner"):
+                    pass
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(timer.names) == 1600
+    for name, state, parent in zip(timer.names, timer.states, timer.parents):
+        assert state == (name == "inner")
+        assert parent == -1 or timer.names[parent] == "outer"
+
+
+def test_exit_out_of_order():
+    """Test leaving a section within a generator after a later section was entered."""
+    timer = Timer3()
+
+    def read():
+        with timer.time("read"):
+            yield
+
+    reader = read()
+    next(reader)
+    with timer.time("process"):
+        next(reader, None)
+    with timer.time("later"):
+        pass
+    assert timer.states == [0, 1, 0]
+    assert timer.current_state == -1
+    assert None not in timer.times
+
+
+def test_exit_in_other_thread():
+    """Test leaving a section in another thread."""
+    timer = Timer3()
+
+    def read():
+        with timer.time("read"):
+            yield
+
+    reader = read()
+    next(reader)
+    thread = threading.Thread(target=next, args=(reader, None))
+    thread.start()
+    thread.join()
+    assert timer.times[0] is not None
+    assert timer.current_state == -1
+
+
+def test_copy():
+    """Test pickling and copying."""
+    timer = Timer3()
+    with timer.time("section"):
+        pass
+    for timer_copy in (pickle.loads(pickle.dumps(timer)), copy.deepcopy(timer)):
+        assert timer_copy.names == timer.names
+        assert timer_copy.times == timer.times
+        with timer_copy.time("section"):
+            pass
+        assert len(timer_copy.names) == 2
+
+
+def test_no_context_variable_per_timer():
+    """Test that timers do not add variables to the context."""
+    context_size = len(contextvars.copy_context())
+    for _ in range(100):
+        timer = Timer3()
+        with timer.time("section"):
+            pass
+    assert len(contextvars.copy_context()) <= context_size + 1
+
+
+def test_call_order_of_sequential_sections(nested_timer):
+    """Test that the records are used as they are unless concurrent sections interleave."""
+    assert nested_timer.sort_by_call_order() == range(10)
+
+    timer = Timer3()
+
+    async def job(i):
+        with timer.time("task"):
+            await asyncio.sleep(0)
+            with timer.time("sub"):
+                pass
+
+    async def main():
+        with timer.time("main"):
+            await asyncio.gather(job(0), job(1))
+
+    asyncio.run(main())
+    assert timer.sort_by_call_order() == [0, 1, 3, 2, 4]
+
+
+def test_columns(nested_timer):
+    """Test the read-only columns of the timer."""
+    names = nested_timer.names
+    assert len(names) == 10
+    assert names[2] == "deep"
+    assert names[-1] == "inner function"
+    assert names[1:3] == ["inner function", "deep"]
+    assert list(nested_timer.name_ids) == [nested_timer.name_table.index(n) for n in names]
+    with pytest.raises(IndexError):
+        names[10]
+    with pytest.raises(AttributeError):
+        nested_timer.names = []
+
+
+def test_export_csv(nested_timer, tmp_path):
+    """Test that the joined rows match the csv module."""
+    file_path = tmp_path / "times.csv"
+    nested_timer.export_csv(file_path)
+    with open(file_path, newline="") as csvfile:
+        rows = list(csv.reader(csvfile))
+    assert rows[0] == ["function names", "", "", "", "time (s)"]
+    assert rows[5] == ["", "", "", "inner function", repr(nested_timer.times[4])]
+
+    reference_path = tmp_path / "reference.csv"
+    with open(reference_path, "w", newline="") as csvfile:
+        rows = zip(nested_timer.names, nested_timer.times, nested_timer.states)
+        Timer3._write_csv_rows(csvfile, rows, 4)
+    assert file_path.read_bytes() == reference_path.read_bytes()
+
+
+def test_export_csv_quoting(tmp_path):
+    """Test the export of names that need quoting and of running sections."""
+    timer = Timer3()
+    file_path = tmp_path / "times.csv"
+    with timer.time('a, "b"'):
+        timer.export_csv(file_path)
+    with open(file_path, newline="") as csvfile:
+        rows = list(csv.reader(csvfile))
+    assert rows == [["function names", "time (s)"], ['a, "b"', ""]]
+
+
+def test_empty_timer(tmp_path):
+    """Test rendering and exporting a timer without sections."""
+    timer = Timer3()
+    assert "Timer3" in str(timer)
+    assert timer.summary() == {}
+    timer.export_csv(tmp_path / "times.csv")
+
+
+def test_weak_reference():
+    """Test that timers can be referenced weakly."""
+    timer = Timer3()
+    assert weakref.ref(timer)() is timer
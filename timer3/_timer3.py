@@ -1,28 +1,366 @@
 """Timer3."""
+import array
+import inspect
+import struct
+import sys
+import threading
 import time
-from contextlib import contextmanager
-from functools import wraps, partial
+import types
+from collections.abc import Sequence
+from contextvars import ContextVar
+from functools import wraps
 import csv
+from collections import defaultdict
+
+_pcn = time.perf_counter_ns
+
+_MAX_SPECIALIZED_ARGS = 8
+
+_CSV_SPECIAL_CHARACTERS = (",", '"', "\r", "\n")
+
+# A record holds the time in nanoseconds, the name id, the index of the calling section and the
+# state of a section
+_RECORD_SIZE = 4
+_pack_record = struct.Struct("4q").pack
+
+# Section entered last in the current thread or task. Sections link to the section that was running
+# when they were entered and are only marked as finished when left, so leaving a section out of
+# order or in another thread or task does not affect the sections running in this one.
+_running_section = ContextVar("timer3_running_section", default=None)
+
+
+def _fixed_arg_names(fun):
+    """Get the argument names of a function with a fixed number of arguments.
+
+    Only plain Python functions are inspected, based on their code object, so callables with a
+    custom signature are never specialized.
+
+    Args:
+        fun (function): Function to inspect
+
+    Returns:
+        list: Argument names or None if the function takes defaults, variable, positional-only or
+              keyword-only arguments
+    """
+    if not isinstance(fun, types.FunctionType):
+        return None
+    code = fun.__code__
+    if (
+        code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS)
+        or code.co_posonlyargcount
+        or code.co_kwonlyargcount
+        or code.co_argcount > _MAX_SPECIALIZED_ARGS
+        or fun.__defaults__
+        or fun.__kwdefaults__
+    ):
+        return None
+    arg_names = list(code.co_varnames[: code.co_argcount])
+    if any(arg_name.startswith("_t3_") for arg_name in arg_names):
+        return None
+    return arg_names
+
+
+def _seconds(time_ns):
+    """Convert a measured time to seconds.
+
+    Args:
+        time_ns (int): Time in nanoseconds, negative for running sections
+
+    Returns:
+        float: Time in seconds or None for running sections
+    """
+    return time_ns / 1e9 if time_ns >= 0 else None
+
+
+class _Column(Sequence):
+    """Read-only view of a column of the timer records.
+
+    Attributes:
+        values (array.array): Array holding the column
+        start (int): Index of the first entry in the array
+        step (int): Distance between two entries in the array
+        convert (function): Function to convert the stored values, None to return them as stored
+    """
+
+    __slots__ = ("values", "start", "step", "convert")
+
+    def __init__(self, values, start=0, step=1, convert=None):
+        """Init the view."""
+        self.values = values
+        self.start = start
+        self.step = step
+        self.convert = convert
+
+    def __len__(self):
+        """Number of entries."""
+        return len(range(self.start, len(self.values), self.step))
+
+    def __getitem__(self, index):
+        """Get an entry or a list of entries."""
+        if isinstance(index, slice):
+            return list(self)[index]
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("column index out of range")
+        value = self.values[self.start + index * self.step]
+        return value if self.convert is None else self.convert(value)
+
+    def __iter__(self):
+        """Iterate over the entries."""
+        values = self.values[self.start :: self.step]
+        return iter(values) if self.convert is None else map(self.convert, values)
+
+    def __eq__(self, other):
+        """Compare the entries with another sequence."""
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        """Represent the entries as a list."""
+        return repr(list(self))
+
+
+class _T3Ctx:
+    """Context timing a single section of a Timer3.
+
+    Entering the context appends the record of the section to the timer, so the records are in
+    call order, and makes it the innermost running section of the current thread or task. The
+    measured time is filled in when leaving the context, which may happen out of order or in
+    another thread, e.g. for sections within generators.
+
+    Attributes:
+        timer (Timer3): Timer to record the section in
+        name_id (int): Id of the name in the name table of the timer
+        position (int): Position of the record of the section in the records of the timer
+        state (int): State of the section
+        parent (_T3Ctx): Calling section or None for outer sections
+        previous (_T3Ctx): Section running when the section was entered in the current thread or
+                           task, possibly of another timer
+        finished (bool): True if the section has been left
+        start_time (int): Start time of the section in nanoseconds
+    """
+
+    __slots__ = (
+        "timer",
+        "name_id",
+        "position",
+        "state",
+        "parent",
+        "previous",
+        "finished",
+        "start_time",
+    )
+
+    def __init__(self, timer, name_id):
+        """Init the context."""
+        self.timer = timer
+        self.name_id = name_id
+
+    def __enter__(self):
+        """Record the section and start timing."""
+        timer = self.timer
+        previous = _running_section.get()
+        while previous is not None and previous.finished:
+            previous = previous.previous
+        parent = previous
+        while parent is not None and parent.timer is not timer:
+            parent = parent.previous
+            while parent is not None and parent.finished:
+                parent = parent.previous
+
+        # Adding the bytes of the record is a single operation on the array, so no lock is needed.
+        # The record is marked by a negative time unique to this context until the section is left.
+        records = timer._records
+        marker = -id(self)
+        if parent is None:
+            records.frombytes(_pack_record(marker, self.name_id, -1, 0))
+            self.state = 0
+        else:
+            state = parent.state + 1
+            parent_index = parent.position // _RECORD_SIZE
+            records.frombytes(_pack_record(marker, self.name_id, parent_index, state))
+            self.state = state
+
+            # Concurrent sections break the call order of the records if they are not nested in
+            # the previously entered section or one of its callers
+            last = timer._last
+            while last is not parent and last is not None:
+                last = last.parent
+            if last is None:
+                timer._interleaved = True
+        timer._last = self
+
+        position = len(records) - _RECORD_SIZE
+        while records[position] != marker:
+            position -= _RECORD_SIZE
+        self.position = position
+        self.parent = parent
+        self.previous = previous
+        self.finished = False
+        _running_section.set(self)
+        self.start_time = _pcn()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop timing and store the measured time."""
+        end_time = _pcn()
+        self.timer._records[self.position] = end_time - self.start_time
+        self.finished = True
+
+
+class _T3LogCtx(_T3Ctx):
+    """Context timing a single section of a Timer3 with verbose output.
+
+    Attributes:
+        log_function (function): Function to write verbose output
+    """
+
+    __slots__ = ("log_function",)
+
+    def __init__(self, timer, name_id, log_function):
+        """Init the context."""
+        super().__init__(timer, name_id)
+        self.log_function = log_function
+
+    def __enter__(self):
+        """Log the start, record the section and start timing."""
+        self.log_function("Starting " + self.timer.name_table[self.name_id])
+        super().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop timing, store the measured time and log it."""
+        super().__exit__(exc_type, exc_value, traceback)
+        timer = self.timer
+        total_time = timer._records[self.position] / 1e9
+        self.log_function(timer.name_table[self.name_id] + f" done, took {total_time}s")
 
 
 class Timer3:
     """Class to time functions or construct timer context.
 
     Attributes:
-        times (list): List of measured times
-        names (list): List of names of the timed sections
-        states (list): List of states
-        state (int): A state describes if the part to be measured was called within another timer
-                     or not. So state 0 is the outer level, 1 means that the part of the code to
-                     being timed is measured during an other time. 2 means double nested ...
+        name_table (list): List of the distinct names, indexed by the name ids
+        times_ns (_Column): Read-only, measured times in nanoseconds, negative for running sections
+        times (_Column): Read-only, measured times in seconds, None for running sections
+        name_ids (_Column): Read-only, ids of the names of the timed sections
+        names (_Column): Read-only, names of the timed sections
+        parents (_Column): Read-only, indices of the calling sections, -1 for outer sections
+        states (_Column): Read-only, states of the timed sections. A state describes if the part
+                          to be measured was called within another timer or not. So state 0 is the
+                          outer level, 1 means that the part of the code to being timed is
+                          measured during an other time. 2 means double nested ...
+        current_state (int): Read-only, state of the innermost running section of the current
+                             thread or task. -1 if no section is running
+
+    The columns are views of the records, which are appended without locking. Each thread and
+    asyncio task keeps track of its own running sections, so the timer can be used concurrently.
+    Tasks created within a running section are nested in it.
     """
 
+    __slots__ = (
+        "_records",
+        "name_table",
+        "_name_index",
+        "_lock",
+        "_last",
+        "_interleaved",
+        "_display_names",
+        "_displayed",
+        "_max_len",
+        "__weakref__",
+    )
+
     def __init__(self):
         """Init the object."""
-        self.times = []
-        self.names = []
-        self.states = []
-        self.current_state = -1
+        self._records = array.array("q")
+        self.name_table = []
+        self._name_index = {}
+        self._lock = threading.Lock()
+        self._last = None
+        self._interleaved = False
+        self._display_names = {}
+        self._displayed = 0
+        self._max_len = 0
+
+    def __getstate__(self):
+        """Get the state without the lock and the running sections."""
+        return {
+            "_records": self._records,
+            "name_table": self.name_table,
+            "_name_index": self._name_index,
+            "_interleaved": self._interleaved,
+        }
+
+    def __setstate__(self, state):
+        """Restore the state with a new lock."""
+        self.__init__()
+        for attribute, value in state.items():
+            setattr(self, attribute, value)
+
+    @property
+    def times_ns(self):
+        """Measured times in nanoseconds, negative for running sections."""
+        return _Column(self._records, 0, _RECORD_SIZE)
+
+    @property
+    def times(self):
+        """Measured times in seconds, None for running sections."""
+        return _Column(self._records, 0, _RECORD_SIZE, _seconds)
+
+    @property
+    def name_ids(self):
+        """Ids of the names of the timed sections."""
+        return _Column(self._records, 1, _RECORD_SIZE)
+
+    @property
+    def names(self):
+        """Names of the timed sections."""
+        return _Column(self._records, 1, _RECORD_SIZE, self.name_table.__getitem__)
+
+    @property
+    def parents(self):
+        """Indices of the calling sections, -1 for outer sections."""
+        return _Column(self._records, 2, _RECORD_SIZE)
+
+    @property
+    def states(self):
+        """States of the timed sections."""
+        return _Column(self._records, 3, _RECORD_SIZE)
+
+    @property
+    def current_state(self):
+        """State of the innermost running section.
+
+        Returns:
+            int: State or -1 if no section is running
+        """
+        section = _running_section.get()
+        while section is not None and (section.timer is not self or section.finished):
+            section = section.previous
+        return -1 if section is None else section.state
+
+    def _name_id(self, name):
+        """Get the id of a name, adding it to the name table if it is new.
+
+        Args:
+            name (str): Name of a timed section
+
+        Returns:
+            int: Id of the name in the name table
+        """
+        name_id = self._name_index.get(name)
+        if name_id is None:
+            with self._lock:
+                name_id = self._name_index.get(name)
+                if name_id is None:
+                    name_id = len(self.name_table)
+                    self.name_table.append(sys.intern(name))
+                    self._name_index[name] = name_id
+        return name_id
 
     def timethis(self, log_function=None, name=None):
         """Decorator factory to time functions.
@@ -44,20 +382,51 @@ class Timer3:
             function: A decorator to wrap the function in
         """
 
-        def decorator(fun, name, log_function):
-            if name is None:
-                name = fun.__qualname__
+        def decorator(fun):
+            name_id = self._name_id(fun.__qualname__ if name is None else name)
+            timer = self
 
-            @wraps(fun)
-            def inner(*args, **kwargs):
-                with self.time(name=name, log_function=log_function):
-                    return fun(*args, **kwargs)
+            arg_names = _fixed_arg_names(fun)
+            if arg_names is None:
+                if log_function:
 
-            return inner
+                    def inner(*args, **kwargs):
+                        with _T3LogCtx(timer, name_id, log_function):
+                            return fun(*args, **kwargs)
 
-        return partial(decorator, name=name, log_function=log_function)
+                else:
+
+                    def inner(*args, **kwargs):
+                        with _T3Ctx(timer, name_id):
+                            return fun(*args, **kwargs)
+
+            else:
+                # Generate a wrapper with the exact arguments to avoid packing *args and **kwargs
+                args = ", ".join(arg_names)
+                if log_function:
+                    context = "_t3_T3LogCtx(_t3_timer, _t3_name_id, _t3_log_function)"
+                else:
+                    context = "_t3_T3Ctx(_t3_timer, _t3_name_id)"
+                namespace = {
+                    "_t3_fun": fun,
+                    "_t3_T3Ctx": _T3Ctx,
+                    "_t3_T3LogCtx": _T3LogCtx,
+                    "_t3_timer": timer,
+                    "_t3_name_id": name_id,
+                    "_t3_log_function": log_function,
+                }
+                exec(
+                    f"def inner({args}):\n"
+                    f"    with {context}:\n"
+                    f"        return _t3_fun({args})\n",
+                    namespace,
+                )
+                inner = namespace["inner"]
+
+            return wraps(fun)(inner)
+
+        return decorator
 
-    @contextmanager
     def time(self, name, log_function=None):
         """Context for timing.
 
@@ -65,103 +434,212 @@ class Timer3:
             log_function (function): This function is used to write verbose output, e.g. print,
                                      logger.debug, logger.warning...
             name (str): Name of the context being timed
+
+        Returns:
+            _T3Ctx: Context timing the section
         """
+        name_id = self._name_index.get(name)
+        if name_id is None:
+            name_id = self._name_id(name)
         if log_function:
-            log_function("Starting " + name)
-        self.current_state += 1
-        start_time = time.perf_counter()
-        yield
-        total_time = time.perf_counter() - start_time
-        self.states.append(self.current_state)
-        self.times.append(total_time)
-        self.names.append(name)
-        self.current_state -= 1
-        if log_function:
-            log_function(name + f" done, took {total_time}s")
+            return _T3LogCtx(self, name_id, log_function)
+        return _T3Ctx(self, name_id)
 
-    def sort_by_call_order(self, states=None, ids=None, current_state=0):
+    def sort_by_call_order(self):
         """Sort by correct call order.
 
-        Args:
-            states (list): List of states
-            ids (list): List of ids for this states
-            current_state (int): State to order
+        Returns:
+            range or list: Ids in call order
         """
-        if states is None:
-            states = self.states
-        if ids is None:
-            ids = range(len(states))
-        current_state_indices = [
-            ids[i] for i, j in enumerate(states) if j == current_state
-        ]
-        nested_states = []
-        subcall_states = []
-        sorted_ids = []
-        subcall_ids = []
-        for id_state, state in zip(ids, states):
-            if id_state in current_state_indices:
+        return self._call_order(self._records[2::_RECORD_SIZE])
 
-                # Add the new state
-                sorted_ids.extend([id_state])
-                nested_states.append([current_state])
+    def _call_order(self, parents):
+        """Sort sections by call order.
 
-                # In case of subcalls
-                if len(subcall_ids) > 0:
+        Sections are recorded when they start, so unless concurrent sections were recorded
+        interleaved, the records are in call order. Otherwise the sections are placed behind their
+        calling sections in a single pass over the recorded parents.
 
-                    # Order the subcalls
-                    subcall_states, subcall_ids = self.sort_by_call_order(
-                        subcall_states, subcall_ids, current_state=current_state + 1
-                    )
+        Args:
+            parents (array.array): Indices of the calling sections
 
-                    # Add the subcalls
-                    nested_states.append(subcall_states)
-                    sorted_ids.extend(subcall_ids)
+        Returns:
+            range or list: Ids in call order
+        """
+        if not self._interleaved:
+            return range(len(parents))
 
-                    # Reset subcalls
-                    subcall_states = []
-                    subcall_ids = []
+        subcall_ids = defaultdict(list)
+        for id_section, parent in enumerate(parents):
+            subcall_ids[parent].append(id_section)
 
-            else:
-                # Update subcalls
-                subcall_ids.extend([id_state])
-                subcall_states.append(state)
+        sorted_ids = []
+        stack = subcall_ids[-1][::-1]
+        while stack:
+            id_section = stack.pop()
+            sorted_ids.append(id_section)
+            stack.extend(reversed(subcall_ids.get(id_section, ())))
+        return sorted_ids
+
+    def _update_display_names(self, name_ids, states):
+        """Add the indented names of sections recorded since the last update.
 
-        # If last only return index
-        if current_state == 0:
-            return sorted_ids
+        The records are only appended, so the indented names and the name width are kept between
+        renders and only new sections are checked.
 
-        # For recursion add the nested states
-        return nested_states, sorted_ids
+        Args:
+            name_ids (array.array): Ids of the names of all sections
+            states (array.array): States of all sections
+        """
+        display_names = self._display_names
+        max_len = self._max_len
+        for key in set(zip(name_ids[self._displayed :], states[self._displayed :])):
+            if key not in display_names:
+                name_id, state = key
+                name = self.name_table[name_id]
+                display_names[key] = "  " * state + name
+                max_len = max(max_len, len(name) + state)
+        self._max_len = max_len
+        self._displayed = len(name_ids)
 
     def __str__(self):
         """Create timer table."""
-        string = ""
-        max_len = min(40, max([len(n) + s for n, s in zip(self.names, self.states)]))
+        records = self._records[:]
+        times_ns = records[0::_RECORD_SIZE]
+        name_ids = records[1::_RECORD_SIZE]
+        states = records[3::_RECORD_SIZE]
+        self._update_display_names(name_ids, states)
+        display_names = self._display_names
+        max_len = min(40, self._max_len)
         row_format = f"| {{:<{max_len+4}}} {{:.8E}} |\n"
-        separator = "+" + "-" * (max_len + 21) + "+"
-        string = separator + "\n"
-        string += "| " + "Timer3".center(len(separator) - 4) + " |\n"
-        string += separator + "\n"
-        for i in self.sort_by_call_order():
-            n, t, s = self.names[i], self.times[i], self.states[i]
-            string += row_format.format("  " * s + n, t)
-        string += separator + "\n"
-        return string
+        running_format = f"| {{:<{max_len+4}}} {'running':>14} |\n"
+        separator = "+" + "-" * (max_len + 21) + "+\n"
+        parts = [
+            separator,
+            "| " + "Timer3".center(len(separator) - 5) + " |\n",
+            separator,
+        ]
+        for i in self._call_order(records[2::_RECORD_SIZE]):
+            name = display_names[name_ids[i], states[i]]
+            t = times_ns[i]
+            if t < 0:
+                parts.append(running_format.format(name))
+            else:
+                parts.append(row_format.format(name, t / 1e9))
+        parts.append(separator)
+        return "".join(parts)
+
+    def summary(self):
+        """Summarize the measured times per name.
+
+        The total time of a name only counts its outermost calls, so the time of recursive calls is
+        not counted twice. The self time of a section is its time without the time of the sections
+        called within it. Sections called concurrently, e.g. tasks gathered within a section, can
+        overlap, so the self time of their calling section is limited to zero. Sections that are
+        still running are skipped.
+
+        Returns:
+            dict: Number of calls, total time and self time in seconds and the number of calls per
+                  state for each name
+        """
+        records = self._records[:]
+        times_ns = records[0::_RECORD_SIZE]
+        name_ids = records[1::_RECORD_SIZE]
+        parents = records[2::_RECORD_SIZE]
+        states = records[3::_RECORD_SIZE]
+        self_times_ns = array.array("q", times_ns)
+        for t, parent in zip(times_ns, parents):
+            if parent >= 0 and t >= 0:
+                self_times_ns[parent] -= t
+
+        totals = {}
+        # Names of the calling sections of the current section and how often they appear
+        chain = []
+        chain_counts = defaultdict(int)
+        for i in self._call_order(parents):
+            name_id, state = name_ids[i], states[i]
+            while len(chain) > state:
+                chain_counts[chain.pop()] -= 1
+            outermost = not chain_counts[name_id]
+            chain.append(name_id)
+            chain_counts[name_id] += 1
+
+            t = times_ns[i]
+            if t < 0:
+                continue
+            calls, total_ns, self_ns, depths = totals.get(name_id, (0, 0, 0, None))
+            if depths is None:
+                depths = defaultdict(int)
+            depths[state] += 1
+            totals[name_id] = (
+                calls + 1,
+                total_ns + t if outermost else total_ns,
+                self_ns + max(self_times_ns[i], 0),
+                depths,
+            )
+        return {
+            self.name_table[i]: {
+                "calls": calls,
+                "total": total_ns / 1e9,
+                "self": self_ns / 1e9,
+                "depths": dict(depths),
+            }
+            for i, (calls, total_ns, self_ns, depths) in totals.items()
+        }
 
     def export_csv(self, file_path):
         """Export timer three to csv.
 
+        Sections that are still running are exported without a time.
+
         Args:
             file_path (str): Path to export data to.
         """
-        max_state = max(self.states) + 1
-        with open(file_path, "w", newline="") as csvfile:
-            csv_writer = csv.writer(csvfile, delimiter=",")
-            row = [""] * max_state + ["time (s)"]
-            row[0] = "function names"
-            csv_writer.writerow(row)
-            for i in self.sort_by_call_order():
-                n, t, s = self.names[i], self.times[i], self.states[i]
-                row = [""] * max_state + [t]
-                row[s] = n
-                csv_writer.writerow(row)
+        records = self._records[:]
+        times_ns = records[0::_RECORD_SIZE]
+        name_ids = records[1::_RECORD_SIZE]
+        states = records[3::_RECORD_SIZE]
+        order = self._call_order(records[2::_RECORD_SIZE])
+        if not isinstance(order, range):
+            times_ns, name_ids, states = (
+                [column[i] for i in order] for column in (times_ns, name_ids, states)
+            )
+        name_table = self.name_table
+        max_state = max(states, default=0) + 1
+        rows = (
+            (name_table[n], t / 1e9 if t >= 0 else "", s)
+            for t, n, s in zip(times_ns, name_ids, states)
+        )
+        with open(file_path, "w", newline="", buffering=1 << 20) as csvfile:
+            if any(c in n for n in name_table for c in _CSV_SPECIAL_CHARACTERS):
+                self._write_csv_rows(csvfile, rows, max_state)
+                return
+
+            # Without characters to quote, the rows can be joined directly
+            csvfile.write("function names" + "," * max_state + "time (s)\r\n")
+            csvfile.writelines(
+                f"{',' * s}{n}{',' * (max_state - s)}{t}\r\n"
+                for n, t, s in rows
+            )
+
+    @staticmethod
+    def _write_csv_rows(csvfile, rows, max_state):
+        """Write timer three with the csv module.
+
+        Args:
+            csvfile (file): File to write to
+            rows (iterable): Name, time in seconds and state per section in call order
+            max_state (int): Number of name columns
+        """
+        template = [""] * (max_state + 1)
+        header = template[:]
+        header[0] = "function names"
+        header[-1] = "time (s)"
+        csv_rows = [header]
+        for n, t, s in rows:
+            row = template[:]
+            row[s] = n
+            row[-1] = t
+            csv_rows.append(row)
+        csv_writer = csv.writer(csvfile, delimiter=",")
+        csv_writer.writerows(csv_rows)